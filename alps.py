@@ -12,6 +12,8 @@ from tqdm import tqdm
 
 from utils import get_data, get_pretrain
 from load_data_addon import Bandit_multi
+from run_logger import RunLogger
+from device_data import DeviceData
 
 def train_cls_batch(model, X, y, num_epochs=10, lr=0.001, batch_size=64):
     model.train()
@@ -282,7 +284,7 @@ def run(n=1000, budget=0.05, num_epochs=10, dataset_name='covertype', begin=1):
     if len(X.shape) == 3:
         N, h, w = X.shape
         X = np.reshape(X, (N, h*w))
-    dataset = TensorDataset(torch.tensor(X.astype(np.float32)), torch.tensor(Y.astype(np.int64)))
+    dataset = DeviceData(X, Y, device=device)
 
     regret = []
     # [x, y (scalar)]
@@ -325,11 +327,11 @@ def run(n=1000, budget=0.05, num_epochs=10, dataset_name='covertype', begin=1):
     p_list = []
     tf = time.time()
     time_cost = 0.0
+    log = RunLogger(f"results_np/{dataset_name}/alps_res.txt", ['rounds', 'query_num', 'bud_percent', 'num_epochs', 'regret'], meta=dict(method='alps', dataset=dataset_name, n=n, budget=budget, num_epochs=num_epochs))
 
     for i in range(n):
-        xn, yn = dataset[i]
-        xn = xn.view(1, -1).to(device)
-        yn = yn.view(-1).float().to(device)
+        xn, yn = dataset.row(i)
+        yn = yn.view(-1).float()
         temp = time.time()
         if i == 0:
             hn = H_class[0]
@@ -402,10 +404,7 @@ def run(n=1000, budget=0.05, num_epochs=10, dataset_name='covertype', begin=1):
             tf = time.time()
 
         regret.append(current_regret)
-        print(f'{i},{query_num},{budget},{num_epochs},{current_regret}')
-        f = open(f"results_np/{dataset_name}/alps_res.txt", 'a')
-        f.write(f'{i},{query_num},{budget},{num_epochs},{current_regret}\n')
-        f.close()
+        log.record(i, query_num, budget, num_epochs, current_regret)
 
 
     print('-------TESTING-------')
@@ -414,9 +413,8 @@ def run(n=1000, budget=0.05, num_epochs=10, dataset_name='covertype', begin=1):
         acc = 0
         for i in range(n, n+lim):
             ind = random.randint(n, len(dataset)-1)
-            xn, yn = dataset[ind]
-            xn = xn.view(1, -1).to(device)
-            yn = yn.view(-1).float().to(device)
+            xn, yn = dataset.row(ind)
+            yn = yn.view(-1).float()
             temp = time.time()
             if i == 0:
                 hn = H_class[0]
@@ -430,11 +428,9 @@ def run(n=1000, budget=0.05, num_epochs=10, dataset_name='covertype', begin=1):
                 lbl = yn.item()
                 if pred == lbl:
                     acc += 1
-        print(f'Testing accuracy: {acc/lim}\n')
-        f = open(f"results_np/{dataset_name}/alps_res.txt", 'a')
-        f.write(f'Testing accuracy: {acc/lim}\n')
-        f.close()
+        log.note(f'Testing accuracy: {acc/lim}')
         
+    log.close()
     return inf_time, train_time, test_inf_time
     
 device = 'cuda'
@@ -0,0 +1,51 @@
+import torch
+
+
+class LabeledBuffer:
+    """Labeled (x, y) rows in preallocated storage that doubles when full.
+       Rows are stored detached and contiguous, X and Y are zero-copy views
+       of the filled part.
+    """
+    def __init__(self, capacity=64, device=None):
+        self.capacity = capacity
+        self.device = device
+        self.n = 0
+        self._X, self._Y = None, None
+
+    def __len__(self):
+        return self.n
+
+    def append(self, x, y):
+        x = torch.as_tensor(x).detach().reshape(-1)
+        y = torch.as_tensor(y).detach()
+        if self._X is None:
+            device = self.device or x.device
+            self._X = torch.empty(self.capacity, *x.shape, device=device)
+            self._Y = torch.empty(self.capacity, *y.shape, device=device)
+        elif self.n == len(self._X):
+            self._X = self._grow(self._X)
+            self._Y = self._grow(self._Y)
+        self._X[self.n] = x.to(self._X.device)
+        self._Y[self.n] = y.to(self._Y.device)
+        self.n += 1
+
+    def _grow(self, t):
+        new = torch.empty(2 * len(t), *t.shape[1:], dtype=t.dtype, device=t.device)
+        new[:self.n] = t[:self.n]
+        return new
+
+    def state_dict(self):
+        return {'X': self.X.cpu(), 'Y': self.Y.cpu()} if self.n else {}
+
+    def load_state_dict(self, state):
+        self.n, self._X, self._Y = 0, None, None
+        for x, y in zip(state.get('X', []), state.get('Y', [])):
+            self.append(x, y)
+
+    @property
+    def X(self):
+        return self._X[:self.n]
+
+    @property
+    def Y(self):
+        return self._Y[:self.n]
@@ -0,0 +1,34 @@
+import numpy as np
+import torch
+
+
+class DeviceData:
+    """Features (float32, flattened per sample) and labels (int64, shifted by
+       begin) of a dataset, moved to the device once. Rows are gathered by
+       index; split() gives train/test views without copying.
+    """
+    def __init__(self, X, Y, begin=0, device=None):
+        X = np.asarray(X)
+        if X.ndim == 3:
+            X = X.reshape(len(X), -1)
+        self.X = torch.as_tensor(X.astype(np.float32), device=device)
+        self.Y = torch.as_tensor(np.asarray(Y).astype(np.int64) - begin, device=device)
+
+    @classmethod
+    def _view(cls, X, Y):
+        data = cls.__new__(cls)
+        data.X, data.Y = X, Y
+        return data
+
+    def __len__(self):
+        return len(self.X)
+
+    def __getitem__(self, idx):
+        return self.X[idx], self.Y[idx]
+
+    def row(self, i):
+        # one sample as a [1, d] batch and its label
+        return self.X[i:i+1], self.Y[i]
+
+    def split(self, n):
+        return DeviceData._view(self.X[:n], self.Y[:n]), DeviceData._view(self.X[n:], self.Y[n:])
@@ -0,0 +1,233 @@
+import math
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, vmap, grad
+
+
+def per_sample_grads(net, X):
+    """Gradient of net(x).sum() w.r.t. the parameters of net, flattened in
+       net.parameters() order, for every row x of X. Returns a [B, P] tensor.
+    """
+    params = {name: p.detach() for name, p in net.named_parameters()}
+
+    def f(params, x):
+        return functional_call(net, params, (x.unsqueeze(0),)).sum()
+
+    grads = vmap(grad(f), in_dims=(None, 0))(params, X)
+    return torch.cat([g.reshape(X.shape[0], -1) for g in grads.values()], dim=1)
+
+
+def two_layer_grads(net, X):
+    """Closed-form version of per_sample_grads for a fc1 -> ReLU -> fc2 network.
+       No autograd graph is built.
+    """
+    W1, b1, W2 = net.fc1.weight, net.fc1.bias, net.fc2.weight
+    B, k = X.shape[0], W2.shape[0]
+    with torch.no_grad():
+        pre = X @ W1.T + b1
+        h = torch.relu(pre)
+        # d f.sum() / d pre, ReLU passes gradient only where pre > 0
+        g = W2.sum(0) * (pre > 0)
+        return torch.cat([
+            (g.unsqueeze(2) * X.unsqueeze(1)).reshape(B, -1),
+            g,
+            h.repeat(1, k),
+            torch.ones(B, k, dtype=X.dtype, device=X.device),
+        ], dim=1)
+
+
+def block_mean(G, block_size=51):
+    """Mean over contiguous blocks of the last dimension of G, zero-padding the
+       tail exactly like skimage.measure.block_reduce(..., func=np.mean).
+       Runs on G's device and works on batches.
+    """
+    G = F.pad(G, (0, -G.shape[-1] % block_size))
+    return G.reshape(*G.shape[:-1], -1, block_size).mean(-1)
+
+
+def _outer_prefix(a, b, t, col=0, row_len=None):
+    # prefix sums of the row-major flattening of outer(a[i], b[i]) at offsets t, where
+    # each row of length row_len holds b[i] from column col[i] on and zeros elsewhere
+    C = b.shape[1]
+    L = C if row_len is None else row_len
+    cum_a = F.pad(a.cumsum(1), (1, 0))
+    cum_b = F.pad(b.cumsum(1), (1, 0))
+    r, c = t // L, t % L
+    c = (c - col).clamp(0, C).expand(a.shape[0], -1)
+    return cum_a[:, r] * cum_b[:, -1:] + F.pad(a, (0, 1))[:, r] * cum_b.gather(1, c)
+
+
+def _segment_block_mean(segments, block_size, normalize, dtype):
+    # segments are (grad_out, input[, col, row_len]) of each nn.Linear parameter, in order
+    segments = [s if len(s) == 4 else (*s, 0, s[1].shape[1]) for s in segments]
+    device = segments[0][0].device
+    P = sum(a.shape[1] * L for a, _, _, L in segments)
+    bounds = torch.arange(math.ceil(P / block_size) + 1, device=device) * block_size
+    # float64 keeps the differences of large prefix sums exact enough
+    S, offset = 0, 0
+    for a, b, col, L in segments:
+        size = a.shape[1] * L
+        S = S + _outer_prefix(a.double(), b.double(), (bounds - offset).clamp(0, size), col, L)
+        offset += size
+    dc = (S[:, 1:] - S[:, :-1]) / block_size
+
+    if normalize:
+        norm = sum((a.double() ** 2).sum(1) * (b.double() ** 2).sum(1) for a, b, _, _ in segments)
+        dc = dc / norm.sqrt().unsqueeze(1)
+    return dc.to(dtype)
+
+
+def factored_block_mean(net, X, block_size=51, normalize=False):
+    """block_mean(two_layer_grads(net, X)) computed from the outer-product
+       structure of each nn.Linear gradient, so the [B, P] gradient is never
+       built. Memory per sample is O(dim + hidden + P / block_size).
+    """
+    W1, b1, W2 = net.fc1.weight, net.fc1.bias, net.fc2.weight
+    B, k = X.shape[0], W2.shape[0]
+    with torch.no_grad():
+        pre = X @ W1.T + b1
+        h = torch.relu(pre)
+        g = W2.sum(0) * (pre > 0)
+        one = torch.ones(B, 1, dtype=X.dtype, device=X.device)
+        ones_k = one.expand(B, k)
+        # (grad_out, input) of fc1.weight, fc1.bias, fc2.weight, fc2.bias
+        return _segment_block_mean([(g, X), (g, one), (ones_k, h), (ones_k, one)], block_size, normalize, X.dtype)
+
+
+def pad_arm(x, w, k):
+    # arm w of x: x in block w of a k * d vector, zeros elsewhere
+    arm = x.new_zeros(k, x.numel())
+    arm[w] = x.view(-1)
+    return arm.view(-1)
+
+
+def arm_forward(net, x, k, params=None):
+    """net(pad_arm(x, w, k)) for all k arms of a fc1 -> activate -> fc2 network
+       with one reshaped matmul, never building the arms. Returns [k, out].
+    """
+    p = params or dict(net.named_parameters())
+    W1 = p['fc1.weight']
+    pre = (W1.view(W1.shape[0], k, -1) @ x.view(-1)).T + p['fc1.bias']
+    return F.linear(net.activate(pre), p['fc2.weight'], p['fc2.bias'])
+
+
+def per_arm_grads(net, x, k):
+    # per_sample_grads of the k arms of x
+    params = {name: p.detach() for name, p in net.named_parameters()}
+
+    def f(params, e):
+        return (arm_forward(net, x, k, params).sum(1) * e).sum()
+
+    grads = vmap(grad(f), in_dims=(None, 0))(params, torch.eye(k, dtype=x.dtype, device=x.device))
+    return torch.cat([g.reshape(k, -1) for g in grads.values()], dim=1)
+
+
+def _arm_terms(net, x, k):
+    W1, b1, W2 = net.fc1.weight, net.fc1.bias, net.fc2.weight
+    pre = (W1.view(W1.shape[0], k, -1) @ x.view(-1)).T + b1
+    return torch.relu(pre), W2.sum(0) * (pre > 0)
+
+
+def arm_two_layer_grads(net, x, k):
+    # two_layer_grads of the k arms of x, the fc1 weight gradient of arm w only fills block w
+    out = net.fc2.weight.shape[0]
+    with torch.no_grad():
+        h, g = _arm_terms(net, x, k)
+        H, d = g.shape[1], x.numel()
+        gw = g.new_zeros(k, H, k, d)
+        w = torch.arange(k, device=x.device)
+        gw[w, :, w, :] = g.unsqueeze(2) * x.view(1, 1, d)
+        return torch.cat([gw.reshape(k, -1), g, h.repeat(1, out), torch.ones(k, out, dtype=x.dtype, device=x.device)], dim=1)
+
+
+def arm_block_mean(net, x, k, block_size=51, normalize=False):
+    # factored_block_mean of the k arms of x, with x placed at column w * d of fc1's input
+    out = net.fc2.weight.shape[0]
+    with torch.no_grad():
+        h, g = _arm_terms(net, x, k)
+        d = x.numel()
+        xs = x.view(1, d).expand(k, d)
+        col = (torch.arange(k, device=x.device) * d).unsqueeze(1)
+        one = torch.ones(k, 1, dtype=x.dtype, device=x.device)
+        segments = [(g, xs, col, k * d), (g, one), (one.expand(k, out), h), (one.expand(k, out), one)]
+        return _segment_block_mean(segments, block_size, normalize, x.dtype)
+
+
+def flat_grads(net, X, mode='autograd'):
+    if mode == 'autograd':
+        return per_sample_grads(net, X)
+    if mode == 'closed_form':
+        return two_layer_grads(net, X)
+    raise ValueError(f'Unknown embedding mode: {mode}')
+
+
+class BlockMean:
+    """Contiguous block mean, the original exploration embedding."""
+    def __init__(self, block_size=51):
+        self.block_size = block_size
+
+    def __call__(self, G):
+        return block_mean(G, self.block_size)
+
+
+class CountSketch:
+    """Seeded sparse random projection of the gradient: every coordinate is added,
+       with a random sign, to one of out_dim buckets. The same (in_dim, out_dim,
+       seed) always gives the same mapping.
+    """
+    def __init__(self, in_dim, out_dim, seed=0):
+        self.in_dim, self.out_dim, self.seed = in_dim, out_dim, seed
+        gen = torch.Generator().manual_seed(seed)
+        bucket = torch.randint(out_dim, (in_dim,), generator=gen)
+        sign = torch.randint(2, (in_dim,), generator=gen).float() * 2 - 1
+        self.S = torch.sparse_coo_tensor(torch.stack([bucket, torch.arange(in_dim)]), sign, (out_dim, in_dim)).coalesce()
+
+    def __call__(self, G):
+        if self.S.device != G.device:
+            self.S = self.S.to(G.device)
+        out = torch.sparse.mm(self.S, G.reshape(-1, self.in_dim).T.to(self.S.dtype)).T
+        return out.reshape(*G.shape[:-1], self.out_dim).to(G.dtype)
+
+
+def make_reducer(name, in_dim, out_dim, seed=0, block_size=51):
+    if name == 'block':
+        if out_dim != math.ceil(in_dim / block_size):
+            raise ValueError(f'block reducer maps {in_dim} gradient entries to {math.ceil(in_dim / block_size)}, not {out_dim}')
+        return BlockMean(block_size)
+    if name == 'sketch':
+        return CountSketch(in_dim, out_dim, seed)
+    raise ValueError(f'Unknown reducer: {name}')
+
+
+def grad_embedding(net, X, mode='autograd', normalize=False, reducer=None):
+    """Reduced gradient embedding of every row of X. mode is 'autograd',
+       'closed_form' or 'factored' (never materializes the full gradient,
+       block reducer only). reducer defaults to BlockMean().
+    """
+    reducer = reducer or BlockMean()
+    if mode == 'factored':
+        if not isinstance(reducer, BlockMean):
+            raise ValueError('factored embedding only supports the block reducer')
+        return factored_block_mean(net, X, reducer.block_size, normalize)
+    G = flat_grads(net, X, mode)
+    if normalize:
+        G = G / torch.linalg.norm(G, dim=1, keepdim=True)
+    return reducer(G)
+
+
+def arm_grad_embedding(net, x, k, mode='autograd', normalize=False, reducer=None):
+    """grad_embedding of the k arms pad_arm(x, w, k), without building them."""
+    reducer = reducer or BlockMean()
+    if mode == 'factored':
+        if not isinstance(reducer, BlockMean):
+            raise ValueError('factored embedding only supports the block reducer')
+        return arm_block_mean(net, x, k, reducer.block_size, normalize)
+    if mode == 'autograd':
+        G = per_arm_grads(net, x, k)
+    elif mode == 'closed_form':
+        G = arm_two_layer_grads(net, x, k)
+    else:
+        raise ValueError(f'Unknown embedding mode: {mode}')
+    if normalize:
+        G = G / torch.linalg.norm(G, dim=1, keepdim=True)
+    return reducer(G)
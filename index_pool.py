@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class IndexPool:
+    """Set of sample indices with O(1) seeded uniform draws and O(1) swap-removal.
+       The indices still in the pool are order[:size], removed ones follow them.
+    """
+    def __init__(self, n, seed=None):
+        self.order = np.arange(n)
+        self.pos = np.arange(n)
+        self.size = n
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, idx):
+        return self.pos[idx] < self.size
+
+    def sample(self, m):
+        # m independent uniform draws, nothing is removed
+        return self.order[self.rng.integers(self.size, size=m)]
+
+    def remove(self, idx):
+        p, last = self.pos[idx], self.size - 1
+        if p > last:
+            raise KeyError(f'{idx} is not in the pool')
+        other = self.order[last]
+        self.order[p], self.order[last] = other, idx
+        self.pos[other], self.pos[idx] = p, last
+        self.size = last
+
+    def state_dict(self):
+        return {'order': self.order.copy(), 'size': self.size, 'rng': self.rng.bit_generator.state}
+
+    def load_state_dict(self, state):
+        self.order = state['order'].copy()
+        self.pos = np.empty_like(self.order)
+        self.pos[self.order] = np.arange(len(self.order))
+        self.size = state['size']
+        self.rng.bit_generator.state = state['rng']
+
+
+class PoolPartition(IndexPool):
+    """Labeled/unlabeled split of n samples. Unlabeled indices are order[:size],
+       labeled ones follow them, with a boolean mask for O(1) membership.
+    """
+    def __init__(self, n, seed=None):
+        super().__init__(n, seed)
+        self.mask = np.zeros(n, dtype=bool)
+
+    def __contains__(self, idx):
+        return not self.mask[idx]
+
+    def remove(self, idx):
+        super().remove(idx)
+        self.mask[idx] = True
+
+    @property
+    def unlabeled(self):
+        return self.order[:self.size]
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.mask[:] = True
+        self.mask[self.unlabeled] = False
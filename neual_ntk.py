@@ -13,7 +13,10 @@ from torch.utils.data import DataLoader, TensorDataset
 from utils import get_data
 from load_data import load_mnist_1d
 from load_data_addon import Bandit_multi
-from skimage.measure import block_reduce
+from run_logger import RunLogger
+from device_data import DeviceData
+from buffers import LabeledBuffer
+from embedding import arm_forward, arm_grad_embedding, pad_arm, block_mean
 
 class Network_exploitation(nn.Module):
     def __init__(self, dim, hidden_size=100):
@@ -25,26 +28,20 @@ class Network_exploitation(nn.Module):
     def forward(self, x):
         return self.fc2(self.activate(self.fc1(x)))
 
-def EE_forward(net1, x, Z):
+def EE_forward(net1, x, k, Z, mode='autograd'):
     gamma = 0.1
-    x.requires_grad = True
-    f1 = net1(x)
-    net1.zero_grad()
-    f1.sum().backward(retain_graph=True)
-    dc = torch.cat([p.grad.flatten().detach() for p in net1.parameters()])
-    dc = dc / torch.linalg.norm(dc)
-    dc = block_reduce(dc.cpu(), block_size=51, func=np.mean)
-    dc = torch.from_numpy(dc).to(x.device)
+    with torch.no_grad():
+        f1 = arm_forward(net1, x, k).view(-1)
+    dc = arm_grad_embedding(net1, x, k, mode, normalize=True)
 
     sigma = gamma * dc * dc / Z
-    sigma = torch.sqrt(torch.sum(sigma))
+    sigma = torch.sqrt(torch.sum(sigma, dim=1))
     
     return f1, dc, sigma
 
 def train_NN_batch(model, X, Y, num_epochs=10, lr=0.001, batch_size=32):
     model.train()
-    X = torch.cat(X).float()
-    Y = torch.Tensor(Y).float().reshape(-1, 1)
+    Y = Y.reshape(-1, 1)
     optimizer = optim.Adam(model.parameters(), lr=lr)
     dataset = TensorDataset(X, Y)
     dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
@@ -69,7 +66,7 @@ def train_NN_batch(model, X, Y, num_epochs=10, lr=0.001, batch_size=32):
 
     return batch_loss / num
 
-def run(n=1000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype", explore_size=1350, begin=0, lr=0.001):
+def run(n=1000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype", explore_size=1350, begin=0, lr=0.001, embedding='autograd'):
     os.environ['CUDA_VISIBLE_DEVICES'] = '2'
     data = Bandit_multi(dataset_name)
     X = data.X
@@ -83,57 +80,38 @@ def run(n=1000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype",
     if len(X.shape) == 3:
         N, h, w = X.shape
         X = np.reshape(X, (N, h*w))
-    dataset = TensorDataset(torch.tensor(X.astype(np.float32)), torch.tensor(Y.astype(np.int64)))
+    dataset = DeviceData(X, Y, device=device)
 
     hidden_size = 100 #default value
 
     regret = []
     net1 = Network_exploitation(X.shape[1] * k).to(device)
-    X1_train, X2_train, y1, y2 = [], [], [], []
+    train1, train2 = LabeledBuffer(), LabeledBuffer()
     num_labels = int(n * budget)
     current_regret = 0.0
     query_num = 0
-    ci = torch.zeros(1, X.shape[1]).to(device)
     inf_time = 0
     train_time = 0
     test_inf_time = 0
 
     total_param = torch.cat([p.flatten().detach() for p in net1.parameters()])
     total_param = total_param / torch.linalg.norm(total_param)
-    total_param = block_reduce(total_param.cpu(), block_size=51, func=np.mean)
-    total_param = torch.from_numpy(total_param).to(device)
+    total_param = block_mean(total_param)
     
     Z = 1.0 * torch.ones(total_param.shape).to(device)
+    log = RunLogger(f"results_np/{dataset_name}/ntk_ineural_res.txt", ['rounds', 'query_num', 'bud_percent', 'num_epochs', 'regret'], meta=dict(method='neual_ntk', dataset=dataset_name, n=n, budget=budget, num_epochs=num_epochs, embedding=embedding))
 
     for i in range(n):
         try:
-            x, y = dataset[i]
+            x, y = dataset.row(i)
         except:
             break
-        x = x.view(1, -1).to(device)
-
-        # creating the long vectors
-        arms = torch.zeros(k, k*x.shape[1]).to(device)
-        for w in range(k):
-            a = []
-            for j in range(0,w):
-                a.append(ci)
-            a.append(x)
-            for j in range(w+1,k):
-                a.append(ci)
-            arms[w]=torch.cat(a,dim=1)
 
         #should we query for a vector
-        f1 = torch.zeros(k).to(device)
-        u = torch.zeros(k).to(device)
-        dc = torch.zeros(k, explore_size).to(device)
-        sigma = torch.zeros(k).to(device)
-
-        for j in range(k):
-            temp = time.time()
-            f1[j], dc[j], sigma[j] = EE_forward(net1, arms[j], Z)
-            inf_time = inf_time + time.time() - temp
-            u[j] = f1[j] + sigma[j].item()
+        temp = time.time()
+        f1, dc, sigma = EE_forward(net1, x, k, Z, embedding)
+        inf_time = inf_time + time.time() - temp
+        u = f1 + sigma
 
         val, idx = u.sort()
         max_prob = torch.Tensor([val[-1], idx[-1]])
@@ -157,22 +135,15 @@ def run(n=1000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype",
             query_num += 1
 
             #add predicted rewards to the sets
-            temp = torch.reshape(arms[pred], (1, arms[pred].shape[0]))
-            X1_train.append(temp)
-            temp = torch.reshape(dc[pred], (1, dc[pred].shape[0]))
-            X2_train.append(temp)
-            y1.append(reward)
-            y2.append(reward - f1[lbl])
+            train1.append(pad_arm(x, pred, k), reward)
+            train2.append(dc[pred], reward - f1[lbl])
 
             temp = time.time()
-            #train_NN_batch(net1, X1_train, y1, num_epochs=num_epochs, lr=lr)
-            #train_NN_batch(net2, X2_train, y2, num_epochs=num_epochs, lr=lr)
+            #train_NN_batch(net1, train1.X, train1.Y, num_epochs=num_epochs, lr=lr)
+            #train_NN_batch(net2, train2.X, train2.Y, num_epochs=num_epochs, lr=lr)
             train_time = train_time + time.time() - temp
         regret.append(current_regret)
-        print(f'{i},{query_num},{num_labels},{num_epochs},{current_regret}')
-        f = open(f"results_np/{dataset_name}/ntk_ineural_res.txt", 'a')
-        f.write(f'{i},{query_num},{num_labels},{num_epochs},{current_regret}\n')
-        f.close()
+        log.record(i, query_num, num_labels, num_epochs, current_regret)
 
 
     print('-------TESTING-------')
@@ -181,31 +152,13 @@ def run(n=1000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype",
         acc = 0
         for i in range(n, n+lim):
             ind = random.randint(n, len(dataset)-1)
-            x, y = dataset[ind]
-            x = x.view(1, -1).to(device)
-
-            # creating the long vectors
-            arms = torch.zeros(k, k*x.shape[1]).to(device)
-            for w in range(k):
-                a = []
-                for j in range(0,w):
-                    a.append(ci)
-                a.append(x)
-                for j in range(w+1,k):
-                    a.append(ci)
-                arms[w]=torch.cat(a,dim=1)
+            x, y = dataset.row(ind)
 
             #inference
-            f1 = torch.zeros(k).to(device)
-            u = torch.zeros(k).to(device)
-            dc = torch.zeros(k, explore_size).to(device)
-            sigma = torch.zeros(k).to(device)
-
-            for j in range(k):
-                temp = time.time()
-                f1[j], dc[j], sigma[j] = EE_forward(net1, arms[j], Z)
-                inf_time = inf_time + time.time() - temp
-                u[j] = f1[j] + sigma[j].item()
+            temp = time.time()
+            f1, dc, sigma = EE_forward(net1, x, k, Z, embedding)
+            inf_time = inf_time + time.time() - temp
+            u = f1 + sigma
 
             val, idx = u.sort()
             max_prob = torch.Tensor([val[-1], idx[-1]])
@@ -213,13 +166,11 @@ def run(n=1000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype",
             lbl = y.item()
             if pred == lbl:
                 acc += 1
-        print(f'Testing accuracy: {acc/lim}\n')        
-        f = open(f"results_np/{dataset_name}/ntk_ineural_res.txt", 'a')
-        f.write(f'Testing accuracy: {acc/lim}\n')
-        f.close()
+        log.note(f'Testing accuracy: {acc/lim}')
     
     print(f'time: {inf_time} + {train_time} = {inf_time + train_time}')
 
+    log.close()
     return inf_time, train_time, test_inf_time
 
 
@@ -7,12 +7,20 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
 from torch.utils.data import DataLoader, TensorDataset
 from tqdm import tqdm
 from models import CNNnet, MLP, ResNet18, ResNet10, VGG11, CNNAvgPool
 import pickle
-from skimage.measure import block_reduce
+from embedding import grad_embedding, make_reducer, BlockMean
 from load_data_addon import Bandit_multi
+from buffers import LabeledBuffer
+from run_logger import RunLogger
+from device_data import DeviceData
+from functools import partial
+from pool_scoring import PoolScorer, ShardedScorer, DistributedScorer, ScoreCache, sample_distribution
+from index_pool import PoolPartition
+from checkpoint import save_checkpoint, load_checkpoint, rng_state, set_rng_state
 
 # Model
 class Network_exploitation(nn.Module):
@@ -54,43 +62,52 @@ class MLP(nn.Module):
     def forward(self, x):
         return torch.sigmoid(self.fc2(self.activate(self.fc1(x))))
 
-def EE_forward(net1, net2, x, dataset):
+def EE_forward(net1, net2, x, dataset, mode='autograd', reducer=None):
+    if mode != 'autograd':
+        f1, f2, dc = EE_forward_batch(net1, net2, x, mode, reducer)
+        return f1, f2[0], dc[0]
 
     x.requires_grad = True
     f1 = net1(x)
     net1.zero_grad()
     f1.sum().backward(retain_graph=True)
     dc = torch.cat([p.grad.flatten().detach() for p in net1.parameters()])
-    dc = block_reduce(dc.cpu(), block_size=51, func=np.mean)
-    dc = torch.from_numpy(dc).to(x.device)
+    dc = (reducer or BlockMean())(dc)
     f2 = net2(dc)
     return f1, f2, dc
 
-def train_NN_batch(model, X, Y, dataset, dc, num_epochs=64, lr=0.0005, batch_size=256, num_batch=4):
+def EE_forward_batch(net1, net2, X, mode='autograd', reducer=None):
+    # same as EE_forward for every row of X, with per-sample gradients in one pass
+    with torch.no_grad():
+        f1 = net1(X)
+    dc = grad_embedding(net1, X, mode, reducer=reducer)
+    with torch.no_grad():
+        f2 = net2(dc)
+    return f1, f2, dc
+
+def train_NN_batch(model, X, Y, dataset, dc, num_epochs=64, lr=0.0005, batch_size=256, num_batch=4, minibatch=64):
     model.train()
-    X = torch.cat(X).float()
-    Y = torch.stack(Y).float().detach()
-    
     optimizer = optim.Adam(model.parameters(), lr=lr)
     num = X.size(1)
+    X, Y = X.to(device), Y.to(device)
 
     for _ in range(num_batch):
         index = np.arange(len(X))
         np.random.shuffle(index)
-        index = index[:batch_size]
+        index = torch.as_tensor(index[:batch_size], device=device)
         for _ in range(num_epochs):
             batch_loss = 0.0
-            for i in index:
-                x, y = X[i].to(device), Y[i].to(device)
-                y = torch.reshape(y, (1,-1))
-                pred = model(x)
+            for s in range(0, len(index), minibatch):
+                i = index[s:s + minibatch]
+                pred = model(X[i])
 
                 optimizer.zero_grad()
-                loss = torch.mean((pred - y) ** 2)
+                loss = torch.mean((pred - Y[i]) ** 2)
                 loss.backward()
                 optimizer.step()
 
-                batch_loss += loss.item()
+                # summed per sample, as with one step per sample
+                batch_loss += loss.item() * len(i)
             
             if batch_loss / num <= 1e-3:
                 return batch_loss / num
@@ -99,7 +116,7 @@ def train_NN_batch(model, X, Y, dataset, dc, num_epochs=64, lr=0.0005, batch_siz
 
 # Training/Testing script
 
-def run(dev, n=10000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype", explore_size=0, begin=0, lr=0.0001, j=0, mu=1000, gamma=1000):
+def run(dev, n=10000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype", explore_size=0, begin=0, lr=0.0001, j=0, mu=1000, gamma=1000, embedding='autograd', reducer='block', sketch_seed=0, chunk_size=4096, minibatch=64, workers=0, distributed=False, cascade=0, cascade_random=100, cascade_audit=2, rescore_every=1, max_drift=None, refresh=1000):
     data = Bandit_multi(dataset_name)
     X = data.X
     Y = data.y
@@ -111,20 +128,17 @@ def run(dev, n=10000, margin=6, budget=0.05, num_epochs=10, dataset_name="covert
     Y = np.array(Y)
     Y = (Y.astype(np.int64) - begin)[:n]
 
-    train_dataset = TensorDataset(torch.tensor(X.astype(np.float32)), torch.tensor(Y.astype(np.int64)))
-
-    test_x = data.X[n:]
-    test_y = data.y[n:]
-    test_y = np.array(test_y)
-    test_y = (test_y.astype(np.int64) - begin)
-    
-    test_dataset = TensorDataset(torch.tensor(test_x.astype(np.float32)), torch.tensor(test_y.astype(np.int64)))
+    if distributed and not dist.is_initialized():
+        # one process per rank, e.g. torchrun --standalone --nproc_per_node=4 run.py --method p --dist
+        dist.init_process_group('gloo')
+    # with --dist the data stays in host memory and each rank moves only its shard of the pool to the device
+    train_dataset, test_dataset = DeviceData(data.X, data.y, begin, 'cpu' if distributed else device).split(n)
 
     k = len(set(Y))
     net1 = Network_exploitation(dev, X.shape[1], k=k).to(device)
     net2 = Network_exploration(dev, explore_size, k=k).to(device)
 
-    X1_train, X2_train, y1, y2 = [], [], [], []
+    train1, train2 = LabeledBuffer(device=device), LabeledBuffer(device=device)
     budget = int(n * budget)
     inf_time = 0
     train_time = 0
@@ -132,105 +146,119 @@ def run(dev, n=10000, margin=6, budget=0.05, num_epochs=10, dataset_name="covert
     R = 1000
     batch_size = 100
     
-    X1_train, X2_train, y1, y2 = [], [], [], []
-    queried_rows = []
-    j = 0
+    train1, train2 = LabeledBuffer(device=device), LabeledBuffer(device=device)
+    resume, j = j, 0
     net1 = Network_exploitation(dev, X.shape[1], k=k).to(device)
     net2 = Network_exploration(dev, explore_size, k=k).to(device)
+    reducer = make_reducer(reducer, sum(p.numel() for p in net1.parameters()), explore_size, seed=sketch_seed)
+    if cascade and (workers or distributed):
+        raise ValueError('the cascade only runs with the in-process scorer')
+    if cascade and rescore_every > 1:
+        raise ValueError('the cascade and the score cache cannot be combined')
+    if cascade and not cascade_random:
+        raise ValueError('the cascade needs cascade_random > 0 to correct the margins it does not fully score')
+    if distributed:
+        scorer = DistributedScorer(train_dataset.X, net1, net2, partial(EE_forward_batch, mode=embedding, reducer=reducer), chunk_size, device)
+        if scorer.rank > 0:
+            del data, X, Y, train_dataset, test_dataset
+            scorer.serve()
+            dist.destroy_process_group()
+            return inf_time, train_time, test_inf_time
+    elif workers:
+        scorer = ShardedScorer(train_dataset.X, net1, net2, partial(EE_forward_batch, mode=embedding, reducer=reducer), workers, chunk_size)
+    else:
+        scorer = PoolScorer(train_dataset.X, lambda x: EE_forward_batch(net1, net2, x, embedding, reducer), chunk_size, device, screen=net1)
+    partition = PoolPartition(len(scorer))
+    cache = ScoreCache(scorer, (net1, net2), rescore_every, max_drift, refresh) if rescore_every > 1 else None
+
+    log = RunLogger(f"results_np/{dataset_name}/NeurONAL_pool_res.txt", ['text'], meta=dict(method='neuronal_pool', dataset=dataset_name, n=n, budget=budget, embedding=embedding))
+
+    checkpoint_path = f"checkpoints/{dataset_name}/neuronal_pool_{{}}.pt"
+    if resume:
+        # train_NN_batch builds a fresh Adam every round, so there is no optimizer state to restore
+        state = load_checkpoint(checkpoint_path.format(resume))
+        net1.load_state_dict(state['net1'])
+        net2.load_state_dict(state['net2'])
+        train1.load_state_dict(state['train1'])
+        train2.load_state_dict(state['train2'])
+        partition.load_state_dict(state['partition'])
+        if cache:
+            cache.load_state_dict(state['cache'])
+        j, inf_time, train_time = state['j'], state['inf_time'], state['train_time']
+        log.restore(state['log_bytes'])
+        set_rng_state(state['rng'])
+        print(f'resumed from {j} queries')
 
     total_time = 0
+    cascade_changed = []
     while j < R:
-        weights = []
-        indices = []
-        for i in tqdm(range(n)):
-            if i in queried_rows:
-                continue
-            # load data point
-            try:
-                x, y = train_dataset[i]
-            except:
-                break
-            x = x.view(1, -1).to(device)
-
-            # predict via NeurONAL
-            temp = time.time()
-            f1, f2, dc = EE_forward(net1, net2, x, dataset_name)
-            inf_time = inf_time + time.time() - temp
-            u = f1[0] + 1 / (i+1) * f2
-            u_sort, u_ind = torch.sort(u)
-            i_hat = u_sort[-1]
-            i_deg = u_sort[-2]
-            neuronal_pred = int(u_ind[-1].item())
+        # score the unlabeled pool
+        indices = partition.unlabeled
+        temp = time.time()
+        if cascade:
+            weights = scorer.cascade(indices, cascade, cascade_random)
+        elif cache:
+            weights = cache.score(indices)
+        else:
+            weights = scorer.score(indices)
+        inf_time = inf_time + time.time() - temp
 
-            # calculate weight
-            weight = abs(i_hat - i_deg).item()
-            weights.append(weight)
-            indices.append(i)
-        
 
         # create the distribution and sample b points from it
-        i_hat = np.argmin(weights)
-        w_hat = weights[i_hat]
-        distribution = []
         temp = time.time()
-        for x in range(len(weights)):
-            if x != i_hat:
-                quotient = (mu * w_hat + gamma * (weights[x] - w_hat))
-                distribution.append((w_hat / quotient))
-            else:
-                distribution.append(0)
-        distribution[i_hat] = max(1 - sum(distribution), 0)
-
-        total = sum(distribution)
-        distribution = [w/total for w in distribution]
-        inf_time = time.time() - temp
-
-        # sample from distribution
-        ind = np.random.choice(indices, size=batch_size, replace=False, p=distribution)
-
-        for i in ind:
-            x, y = train_dataset[i]
-            x = x.view(1, -1).to(device)
+        rng = np.random.get_state()
+        ind = indices[sample_distribution(weights, mu, gamma, batch_size)]
+        inf_time = inf_time + time.time() - temp
+
+        if cascade and cascade_audit and (j // batch_size) % cascade_audit == 0:
+            # draw again from the fully scored pool with the same random numbers
+            after = np.random.get_state()
+            np.random.set_state(rng)
+            full = indices[sample_distribution(scorer.margins(indices), mu, gamma, batch_size)]
+            np.random.set_state(after)
+            changed = len(ind) - len(np.intersect1d(ind, full))
+            cascade_changed.append(changed / len(ind))
+            log.note(f'cascade changed {changed} of {len(ind)} selected points after {j} queries')
+
+        # f1 and dc of the selected points come from the scoring pass
+        temp = time.time()
+        F1, DC = scorer.lookup(ind)
+        inf_time = inf_time + time.time() - temp
+        for i, f1, dc in zip(ind, F1, DC):
+            x, y = train_dataset.row(i)
+            x = x.to(device)
 
-            temp = time.time()
-            f1, f2, dc = EE_forward(net1, net2, x, dataset_name)
-            inf_time = inf_time + time.time() - temp
-            u = f1[0] + 1 / (i+1) * f2
-            u_sort, u_ind = torch.sort(u)
-            i_hat = u_sort[-1]
-            i_deg = u_sort[-2]
-            neuronal_pred = int(u_ind[-1].item())
-            
             # add predicted rewards to the sets
-            X1_train.append(x)
-            X2_train.append(torch.reshape(dc, (1, len(dc))))
             r_1 = torch.zeros(k).to(device)
             r_1[y.item()] = 1
-            y1.append(r_1) 
-            y2.append((r_1 - f1)[0])
+            train1.append(x, r_1)
+            train2.append(dc, r_1 - f1)
 
             # update unlabeled set
-            queried_rows.append(i)
+            partition.remove(i)
 
         # update the model
         temp = time.time()
-        train_NN_batch(net1, X1_train, y1, dataset_name, dc=False, lr=lr)
-        train_NN_batch(net2, X2_train, y2, dataset_name, dc=True, lr=lr)
+        train_NN_batch(net1, train1.X, train1.Y, dataset_name, dc=False, lr=lr, minibatch=minibatch)
+        train_NN_batch(net2, train2.X, train2.Y, dataset_name, dc=True, lr=lr, minibatch=minibatch)
         train_time = train_time + time.time() - temp
+        scorer.clear()
+        if cache:
+            cache.step()
 
         # calculate testing regret   
         current_acc = 0
         for i in tqdm(range(n)):
             # load data point
             try:
-                x, y = test_dataset[i]
+                x, y = test_dataset.row(i)
             except:
                 break
-            x = x.view(1, -1).to(device)
+            x = x.to(device)
 
             # predict via NeurONAL
             temp = time.time()
-            f1, f2, dc = EE_forward(net1, net2, x, dataset_name)
+            f1, f2, dc = EE_forward(net1, net2, x, dataset_name, embedding, reducer)
             inf_time = inf_time + time.time() - temp
             u = f1[0] + 1 / (i+1) * f2
             u_sort, u_ind = torch.sort(u)
@@ -245,11 +273,24 @@ def run(dev, n=10000, margin=6, budget=0.05, num_epochs=10, dataset_name="covert
         testing_acc = current_acc / n
         j += batch_size
         
-        print(f'testing acc after {j} queries: {testing_acc}')
-        f = open(f"results_np/{dataset_name}/NeurONAL_pool_res.txt", 'a')
-        f.write(f'testing acc after {j} queries: {testing_acc}\n')
-        f.close()
-        
+        log.note(f'testing acc after {j} queries: {testing_acc}')
+        if cache:
+            log.note(f'score cache after {j} queries: full rescore {cache.full}, drift {cache.drift:.4f}, hit rate {cache.hit_rate:.4f}')
+        save_checkpoint(checkpoint_path.format(j), {
+            'net1': net1.state_dict(), 'net2': net2.state_dict(),
+            'train1': train1.state_dict(), 'train2': train2.state_dict(), 'partition': partition.state_dict(),
+            'cache': cache.state_dict() if cache else None,
+            'j': j, 'inf_time': inf_time, 'train_time': train_time,
+            'log_bytes': log.checkpoint(), 'rng': rng_state()})
+
+    if cascade_changed:
+        log.note(f'cascade changed {np.mean(cascade_changed):.4f} of the selected points on average over {len(cascade_changed)} audited rounds')
+    log.close()
+    if workers or distributed:
+        scorer.close()
+    if distributed:
+        dist.destroy_process_group()
+
     # Calculating the STD for testing acc
     for _ in range(10):
         test_ind = np.arange(len(test_dataset))
@@ -259,14 +300,14 @@ def run(dev, n=10000, margin=6, budget=0.05, num_epochs=10, dataset_name="covert
         for i in tqdm(test_ind):
             # load data point
             try:
-                x, y = test_dataset[i]
+                x, y = test_dataset.row(i)
             except:
                 break
-            x = x.view(1, -1).to(device)
+            x = x.to(device)
 
             # predict via NeurONAL
             temp = time.time()
-            f1, f2, dc = EE_forward(net1, net2, x, dataset_name)
+            f1, f2, dc = EE_forward(net1, net2, x, dataset_name, embedding, reducer)
             test_inf_time = test_inf_time + time.time() - temp
             u = f1[0] + 1 / (i+1) * f2
             u_sort, u_ind = torch.sort(u)
@@ -1,5 +1,7 @@
 import os
 import time
+import copy
+import threading
 import math
 import random
 import numpy as np
@@ -12,8 +14,13 @@ from torch.utils.data import DataLoader, TensorDataset
 
 from utils import get_data
 from load_data import load_mnist_1d
-from skimage.measure import block_reduce
+from embedding import grad_embedding, make_reducer, BlockMean
 from load_data_addon import Bandit_multi
+from run_logger import RunLogger
+from device_data import DeviceData
+from checkpoint import save_checkpoint, load_checkpoint, rng_state, set_rng_state
+from index_pool import IndexPool
+from buffers import LabeledBuffer
 
 class Network_exploitation(nn.Module):
     def __init__(self, dim, hidden_size=100, k=10):
@@ -36,7 +43,10 @@ class Network_exploration(nn.Module):
     def forward(self, x):
         return self.fc2(self.activate(self.fc1(x)))
 
-def EE_forward(net1, net2, x):
+def EE_forward(net1, net2, x, mode='autograd', reducer=None):
+    if mode != 'autograd':
+        f1, f2, dc = EE_forward_batch(net1, net2, x, mode, reducer)
+        return f1, f2[0], dc[0]
 
     x.requires_grad = True
     f1 = net1(x)
@@ -44,15 +54,21 @@ def EE_forward(net1, net2, x):
     f1.sum().backward(retain_graph=True)
     dc = torch.cat([p.grad.flatten().detach() for p in net1.parameters()])
     #dc = dc / torch.linalg.norm(dc)
-    dc = block_reduce(dc.cpu(), block_size=51, func=np.mean)
-    dc = torch.from_numpy(dc).to(x.device)
+    dc = (reducer or BlockMean())(dc)
     f2 = net2(dc)
     return f1, f2, dc
 
+def EE_forward_batch(net1, net2, X, mode='autograd', reducer=None):
+    # same as EE_forward for every row of X, with per-sample gradients in one pass
+    with torch.no_grad():
+        f1 = net1(X)
+    dc = grad_embedding(net1, X, mode, reducer=reducer)
+    with torch.no_grad():
+        f2 = net2(dc)
+    return f1, f2, dc
+
 def train_NN_batch(model, X, Y, num_epochs=10, lr=0.0001, batch_size=64):
     model.train()
-    X = torch.cat(X).float()
-    Y = torch.stack(Y).float().detach()
     optimizer = optim.Adam(model.parameters(), lr=lr)
     dataset = TensorDataset(X, Y)
     dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
@@ -77,7 +93,107 @@ def train_NN_batch(model, X, Y, num_epochs=10, lr=0.0001, batch_size=64):
 
     return batch_loss / num
 
-def run(n=1000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype", explore_size=0, begin=0, lr=0.0001):
+def train_NN_steps(model, optimizer, X, Y, steps=8, batch_size=64):
+    # fixed number of Adam steps on replayed minibatches, the newest label is always in the batch
+    model.train()
+    n = len(X)
+    batch_loss = 0.0
+    for _ in range(steps):
+        index = np.append(np.random.randint(n, size=min(batch_size, n) - 1), n - 1)
+        index = torch.from_numpy(index).to(X.device)
+        x, y = X[index].to(device), Y[index].to(device)
+        pred = model(x)
+
+        optimizer.zero_grad()
+        loss = torch.mean((pred - y) ** 2)
+        loss.backward()
+        optimizer.step()
+
+        batch_loss += loss.item()
+
+    return batch_loss / steps
+
+def evaluate(net1, net2, X, Y, offset, mode='autograd', reducer=None, chunk_size=1024):
+    # per-sample correctness of the NeurONAL prediction on rows offset, offset+1, ... of the dataset
+    X, Y = X.to(device), Y.to(device)
+    correct = []
+    for s in range(0, len(X), chunk_size):
+        f1, f2, dc = EE_forward_batch(net1, net2, X[s:s+chunk_size], mode, reducer)
+        i = torch.arange(offset + s, offset + s + len(f1), device=device).unsqueeze(1)
+        u = f1 + 1 / (i+1) * f2
+        correct.append(u.argmax(1) == Y[s:s+chunk_size])
+    return torch.cat(correct).cpu().numpy()
+
+class AsyncTrainer:
+    """Trains private copies of net1/net2 on a background thread and publishes a
+       snapshot of them after every training pass. Scoring keeps using the last
+       published pair; version is the number of labels it was trained on.
+    """
+    def __init__(self, net1, net2, num_epochs=10, lr=0.0001, train_mode='full', update_steps=8, replay_batch=64):
+        self.published = (net1, net2)
+        self.version = 0
+        self.train_time = 0
+        self.num_epochs, self.lr = num_epochs, lr
+        self.train_mode, self.update_steps, self.replay_batch = train_mode, update_steps, replay_batch
+        self._nets = (copy.deepcopy(net1), copy.deepcopy(net2))
+        if train_mode == 'incremental':
+            self._opts = [optim.Adam(net.parameters(), lr=lr) for net in self._nets]
+        self._data, self._labels = None, 0
+        self._stop, self._error = False, None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def models(self):
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            return self.published, self.version
+
+    def submit(self, train1, train2):
+        # views of the filled rows stay valid while the buffers keep growing
+        with self._cond:
+            self._data = (train1.X, train1.Y, train2.X, train2.Y)
+            self._labels = len(train1)
+            self._cond.notify()
+
+    def close(self):
+        # finishes the pending pass so the final weights include every label
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join()
+        return self.models()
+
+    def _work(self):
+        try:
+            while True:
+                with self._cond:
+                    while self._labels == self.version and not self._stop:
+                        self._cond.wait()
+                    if self._labels == self.version:
+                        return
+                    (X1, Y1, X2, Y2), labels = self._data, self._labels
+                    new = labels - self.version
+
+                temp = time.time()
+                net1, net2 = self._nets
+                if self.train_mode == 'incremental':
+                    train_NN_steps(net1, self._opts[0], X1, Y1, steps=self.update_steps * new, batch_size=self.replay_batch)
+                    train_NN_steps(net2, self._opts[1], X2, Y2, steps=self.update_steps * new, batch_size=self.replay_batch)
+                else:
+                    train_NN_batch(net1, X1, Y1, num_epochs=self.num_epochs, lr=self.lr)
+                    train_NN_batch(net2, X2, Y2, num_epochs=self.num_epochs, lr=self.lr)
+                snapshot = (copy.deepcopy(net1), copy.deepcopy(net2))
+
+                with self._cond:
+                    self.published, self.version = snapshot, labels
+                    self.train_time += time.time() - temp
+        except Exception as e:
+            with self._cond:
+                self._error = e
+
+def run(n=1000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype", explore_size=0, begin=0, lr=0.0001, embedding='autograd', reducer='block', sketch_seed=0, seed=42, train_mode='full', update_steps=8, replay_batch=64, train_async=False, window=1, window_mode='freeze', test_repeats=0, checkpoint_every=0, checkpoint_path=None, resume=False):
     data = Bandit_multi(dataset_name)
     X = data.X
     Y = data.y
@@ -89,14 +205,15 @@ def run(n=1000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype",
     Y = np.array(Y)
     Y = Y.astype(np.int64) - begin
 
-    dataset = TensorDataset(torch.tensor(X.astype(np.float32)), torch.tensor(Y.astype(np.int64)))
+    dataset = DeviceData(X, Y, device=device)
 
     k = len(set(Y))
     hidden_size = 100 #default value
     regret = []
     net1 = Network_exploitation(X.shape[1], k=k).to(device)
     net2 = Network_exploration(explore_size, k=k).to(device)
-    X1_train, X2_train, y1, y2 = [], [], [], []
+    reducer = make_reducer(reducer, sum(p.numel() for p in net1.parameters()), explore_size, seed=sketch_seed)
+    train1, train2 = LabeledBuffer(device=device), LabeledBuffer(device=device)
     budget = int(n * budget)
     current_regret = 0.0
     query_num = 0
@@ -105,87 +222,162 @@ def run(n=1000, margin=6, budget=0.05, num_epochs=10, dataset_name="covertype",
     train_time = 0
     test_inf_time = 0
 
-    points = np.arange(0, n)
+    pool = IndexPool(n, seed=seed)
+    log = RunLogger(f"results_np/{dataset_name}/neuronal_stream.txt", ['rounds', 'query_num', 'bud_percent', 'num_epochs', 'regret'], meta=dict(method='neuronal_stream', dataset=dataset_name, n=n, budget=budget, num_epochs=num_epochs, embedding=embedding, train_mode=train_mode, window=window))
+
+    if train_mode not in ('full', 'incremental'):
+        raise ValueError(f'Unknown train_mode: {train_mode}')
+    if window_mode not in ('freeze', 'rescore'):
+        raise ValueError(f'Unknown window_mode: {window_mode}')
+    if train_async and (checkpoint_every or resume):
+        raise ValueError('checkpoints need the synchronous trainer to resume bit-identically')
+    checkpoint_path = checkpoint_path or f"checkpoints/{dataset_name}/neuronal_stream.pt"
+    # incremental mode keeps its optimizers across queries, full mode retrains from the whole history
+    if train_async:
+        trainer = AsyncTrainer(net1, net2, num_epochs=num_epochs, lr=lr, train_mode=train_mode, update_steps=update_steps, replay_batch=replay_batch)
+        staleness = []
+    elif train_mode == 'incremental':
+        opt1 = optim.Adam(net1.parameters(), lr=lr)
+        opt2 = optim.Adam(net2.parameters(), lr=lr)
 
     i = 0
-    while query_num < budget:
-        index = random.choice(np.arange(points.size))
+    version = 0
+    if resume:
+        state = load_checkpoint(checkpoint_path if resume is True else resume, )
+        net1.load_state_dict(state['net1'])
+        net2.load_state_dict(state['net2'])
+        if train_mode == 'incremental':
+            opt1.load_state_dict(state['opt1'])
+            opt2.load_state_dict(state['opt2'])
+        train1.load_state_dict(state['train1'])
+        train2.load_state_dict(state['train2'])
+        pool.load_state_dict(state['pool'])
+        i, query_num, current_regret, regret = state['i'], state['query_num'], state['current_regret'], state['regret']
+        inf_time, train_time = state['inf_time'], state['train_time']
+        log.restore(state['log_bytes'])
+        set_rng_state(state['rng'])
+        print(f'resumed from {query_num} queries')
+    saved_at = query_num
+
+    while query_num < budget and len(pool) > 0:
+        if checkpoint_every and query_num - saved_at >= checkpoint_every:
+            saved_at = query_num
+            save_checkpoint(checkpoint_path, {
+                'net1': net1.state_dict(), 'net2': net2.state_dict(),
+                'opt1': opt1.state_dict() if train_mode == 'incremental' else None,
+                'opt2': opt2.state_dict() if train_mode == 'incremental' else None,
+                'train1': train1.state_dict(), 'train2': train2.state_dict(), 'pool': pool.state_dict(),
+                'i': i, 'query_num': query_num, 'current_regret': current_regret, 'regret': regret,
+                'inf_time': inf_time, 'train_time': train_time,
+                'log_bytes': log.checkpoint(), 'rng': rng_state()})
+
+        # window > 1 draws several arrivals at once and scores them in one batched pass
+        window_idx = pool.sample(window)
         try:
-            x, y = dataset[points[index]]
+            xs, ys = dataset[window_idx]
         except:
             break
-        x = x.view(1, -1).to(device)
+
+        if train_async:
+            # score with the last published weights, staleness = labels they have not seen yet
+            (net1, net2), version = trainer.models()
 
         temp = time.time()
-        f1, f2, dc = EE_forward(net1, net2, x)
+        if window == 1:
+            f1, f2, dc = EE_forward(net1, net2, xs, embedding, reducer)
+            F1, F2, DC = f1, f2.unsqueeze(0), dc.unsqueeze(0)
+        else:
+            F1, F2, DC = EE_forward_batch(net1, net2, xs, embedding, reducer)
         inf_time = inf_time + time.time() - temp
-        u = f1[0] + 1 / (i+1) * f2
-        u_sort, u_ind = torch.sort(u)
-        i_hat = u_sort[-1]
-        i_deg = u_sort[-2]
-
-        ind = 0
-        if abs(i_hat - i_deg) < margin * 0.1:
-            i += 1
-            ind = 1
-            points = np.delete(points, index)
-
-            #construct training set        
-            pred = int(u_ind[-1].item())
-
-            lbl = y.item()
-            if pred != lbl:
-                current_regret += 1
-                reward = 0 
-            else:
-                reward = 1
-
-            if ind and (query_num < budget): 
-                query_num += 1
-
-                #add predicted rewards to the sets
-                X1_train.append(x)
-                X2_train.append(torch.reshape(dc, (1, len(dc))))
-                r_1 = torch.zeros(k).to(device)
-                r_1[lbl] = 1
-                y1.append(r_1) 
-                y2.append((r_1 - f1)[0])
 
-                temp = time.time()
-                train_NN_batch(net1, X1_train, y1, num_epochs=num_epochs, lr=lr)
-                train_NN_batch(net2, X2_train, y2, num_epochs=num_epochs, lr=lr)
-                train_time = train_time + time.time() - temp
-            
-            regret.append(current_regret)
-            print(f'{i},{query_num},{budget},{num_epochs},{current_regret}')
-            f = open(f"results_np/{dataset_name}/neuronal_stream.txt", 'a')
-            f.write(f'{i},{query_num},{budget},{num_epochs},{current_regret}\n')
-            f.close()
-        
-    print('-------TESTING-------')
-    lim = 5000
-    for _ in range(5):
-        acc = 0
-        for i in range(n, n+lim):
-            x, y = dataset[i]
-            x = x.view(1, -1).to(device)
-
-            temp = time.time()
-            f1, f2, dc = EE_forward(net1, net2, x)
-            test_inf_time = test_inf_time + time.time() - temp
+        for w, index in enumerate(window_idx):
+            # an arrival queried earlier in the same window is no longer in the pool
+            if index not in pool or query_num >= budget:
+                continue
+            x, y = xs[w:w+1], ys[w]
+            f1, f2, dc = F1[w:w+1], F2[w], DC[w]
+            if train_async:
+                staleness.append(query_num - version)
+
             u = f1[0] + 1 / (i+1) * f2
             u_sort, u_ind = torch.sort(u)
             i_hat = u_sort[-1]
             i_deg = u_sort[-2]
+
+            ind = 0
+            if abs(i_hat - i_deg) < margin * 0.1:
+                i += 1
+                ind = 1
+                pool.remove(index)
+
+                #construct training set        
+                pred = int(u_ind[-1].item())
+
+                lbl = y.item()
+                if pred != lbl:
+                    current_regret += 1
+                    reward = 0 
+                else:
+                    reward = 1
+
+                if ind and (query_num < budget): 
+                    query_num += 1
+
+                    #add predicted rewards to the sets
+                    r_1 = torch.zeros(k).to(device)
+                    r_1[lbl] = 1
+                    train1.append(x, r_1)
+                    train2.append(dc, (r_1 - f1)[0])
+
+                    temp = time.time()
+                    if train_async:
+                        trainer.submit(train1, train2)
+                    elif train_mode == 'incremental':
+                        train_NN_steps(net1, opt1, train1.X, train1.Y, steps=update_steps, batch_size=replay_batch)
+                        train_NN_steps(net2, opt2, train2.X, train2.Y, steps=update_steps, batch_size=replay_batch)
+                    else:
+                        train_NN_batch(net1, train1.X, train1.Y, num_epochs=num_epochs, lr=lr)
+                        train_NN_batch(net2, train2.X, train2.Y, num_epochs=num_epochs, lr=lr)
+                    train_time = train_time + time.time() - temp
+
+                    # 'rescore' re-scores the rest of the window with the updated model, 'freeze' keeps the window's scores
+                    if window_mode == 'rescore' and w + 1 < len(window_idx):
+                        if train_async:
+                            (net1, net2), version = trainer.models()
+                        temp = time.time()
+                        F1[w+1:], F2[w+1:], DC[w+1:] = EE_forward_batch(net1, net2, xs[w+1:], embedding, reducer)
+                        inf_time = inf_time + time.time() - temp
                 
-            pred = int(u_ind[-1].item())
-            lbl = y.item()
-            if pred == lbl:
-                acc += 1
-        print(f'Testing accuracy: {acc/lim}\n')
-        f = open(f"results/{dataset_name}/neuronal_stream.txt", 'a')
-        f.write(f'Testing accuracy: {acc/lim}\n')
-        f.close()
+                regret.append(current_regret)
+                log.record(i, query_num, budget, num_epochs, current_regret)
+        
+    if train_async:
+        (net1, net2), _ = trainer.close()
+        train_time = trainer.train_time
+        if staleness:
+            print(f'weight staleness: mean {np.mean(staleness)}, max {np.max(staleness)} labels')
+            with open(f"results_np/{dataset_name}/neuronal_stream_staleness.txt", 'a') as f:
+                f.writelines(f'{s}\n' for s in staleness)
+
+    log.close()
+
+    print('-------TESTING-------')
+    lim = 5000
+    X_test, Y_test = dataset[n:n+lim]
+    temp = time.time()
+    correct = evaluate(net1, net2, X_test, Y_test, n, embedding, reducer)
+    test_inf_time = test_inf_time + time.time() - temp
+
+    f = open(f"results/{dataset_name}/neuronal_stream.txt", 'a')
+    print(f'Testing accuracy: {correct.mean()}\n')
+    f.write(f'Testing accuracy: {correct.mean()}\n')
+    # repeated measurements are bootstrap resamples of the stored predictions, not new passes
+    accs = [np.random.choice(correct, size=len(correct)).mean() for _ in range(test_repeats)]
+    for r, acc in enumerate(accs):
+        f.write(f'Testing accuracy (resample {r}): {acc}\n')
+    if test_repeats:
+        print(f'Resampled testing accuracy: {np.mean(accs)} +- {np.std(accs)}\n')
+    f.close()
 
     return inf_time, train_time, test_inf_time
 
@@ -0,0 +1,358 @@
+import copy
+from functools import partial
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.distributed as dist
+
+
+class PoolScorer:
+    """Keeps the candidate pool as one device-resident tensor and scores
+       candidates in chunks. forward(X) -> (f1, f2, dc) is a batched EE forward,
+       e.g. a partial of EE_forward_batch. The f1, dc and margin of the last
+       score() call are cached for lookup() until clear(). screen(X) -> f1 is
+       the cheap net1-only forward used by cascade().
+    """
+    def __init__(self, X, forward, chunk_size=4096, device=None, screen=None):
+        self.X = torch.as_tensor(X, dtype=torch.float32, device=device)
+        self.forward = forward
+        self.screen = screen
+        self.chunk_size = chunk_size
+        # global index of the first row of X
+        self.offset = 0
+        self.clear()
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def clear(self):
+        self.pos = np.full(len(self), -1)
+        self.f1 = self.dc = self.weights = None
+
+    def _forward(self, idx):
+        f1s, dcs, weights = [], [], []
+        for s in range(0, len(idx), self.chunk_size):
+            rows = idx[s:s + self.chunk_size]
+            f1, f2, dc = self.forward(self.X[rows - self.offset])
+            u = f1 + f2 / (rows + 1).unsqueeze(1)
+            top = torch.topk(u, 2, dim=1).values
+            f1s.append(f1.detach())
+            dcs.append(dc.detach())
+            weights.append((top[:, 0] - top[:, 1]).detach())
+        return torch.cat(f1s), torch.cat(dcs), torch.cat(weights)
+
+    def score(self, idx):
+        """Margin between the two largest u = f1 + f2 / (i + 1) for every row
+           index in idx. Returns a float64 array aligned with idx.
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        self.clear()
+        if len(idx) == 0:
+            return np.zeros(0)
+        self.f1, self.dc, self.weights = self._forward(torch.as_tensor(idx, device=self.X.device))
+        self.pos[idx] = np.arange(len(idx))
+        return self.weights.double().cpu().numpy()
+
+    def margins(self, idx):
+        # score() without touching the cache
+        idx = torch.as_tensor(np.asarray(idx, dtype=np.int64), device=self.X.device)
+        return self._forward(idx)[2].double().cpu().numpy()
+
+    def cascade(self, idx, top, extra, rng=np.random):
+        """Two-stage score(): the net1 margin of every row with no gradients,
+           then full scoring of the top rows with the smallest net1 margin and
+           of extra rows drawn uniformly from the others. Rows that were not
+           fully scored get their net1 margin plus the mean full - net1 offset
+           of the uniform rows, clipped at 0.
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        if top + extra >= len(idx):
+            return self.score(idx)
+        weights = []
+        with torch.no_grad():
+            for s in range(0, len(idx), self.chunk_size):
+                rows = torch.as_tensor(idx[s:s + self.chunk_size], device=self.X.device)
+                top2 = torch.topk(self.screen(self.X[rows - self.offset]), 2, dim=1).values
+                weights.append(top2[:, 0] - top2[:, 1])
+        weights = torch.cat(weights).double().cpu().numpy()
+
+        pick = np.argpartition(weights, top)[:top]
+        rest = np.ones(len(idx), dtype=bool)
+        rest[pick] = False
+        sample = rng.choice(np.flatnonzero(rest), extra, replace=False)
+        full = self.score(idx[np.concatenate([pick, sample])])
+        if extra:
+            # the uniform rows estimate how far net1 is from the full margin on the rows left unscored
+            rest[sample] = False
+            weights[rest] = np.maximum(weights[rest] + np.mean(full[top:] - weights[sample]), 0)
+        weights[pick] = full[:top]
+        weights[sample] = full[top:]
+        return weights
+
+    def lookup(self, idx):
+        """f1 and dc of the rows in idx, read from the last score() call.
+           Rows it did not score are computed.
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        pos = self.pos[idx]
+        hit = pos >= 0
+        if hit.all():
+            pos = torch.as_tensor(pos, device=self.X.device)
+            return self.f1[pos], self.dc[pos]
+        f1, dc, _ = self._forward(torch.as_tensor(idx[~hit], device=self.X.device))
+        if hit.any():
+            out_f1, out_dc = f1.new_empty(len(idx), f1.shape[1]), dc.new_empty(len(idx), dc.shape[1])
+            out_f1[~hit], out_dc[~hit] = f1, dc
+            pos = torch.as_tensor(pos[hit], device=self.X.device)
+            hit = torch.as_tensor(hit, device=self.X.device)
+            out_f1[hit], out_dc[hit] = self.f1[pos], self.dc[pos]
+            return out_f1, out_dc
+        return f1, dc
+
+
+
+
+class ScoreCache:
+    """Candidate margins kept across rounds, each tagged with the model version
+       it was computed with. score() rescores the whole pool every `every`
+       rounds or once the relative parameter drift since the last full pass
+       exceeds max_drift; otherwise only the `refresh` cached candidates with
+       the smallest margin, the likeliest to be sampled, are rescored.
+       step() marks a model update.
+    """
+    def __init__(self, scorer, nets, every=5, max_drift=None, refresh=1000):
+        self.scorer, self.nets = scorer, nets
+        self.every, self.refresh = every, refresh
+        self.max_drift = np.inf if max_drift is None else max_drift
+        self.weights = np.zeros(len(scorer))
+        self.version = np.full(len(scorer), -1)
+        self.model_version = 0
+        self.since_full = 0
+        self.ref = None
+        self.drift = 0.0
+        self.full = False
+        self.hits = self.lookups = 0
+
+    def _params(self):
+        return [p.detach().clone() for net in self.nets for p in net.parameters()]
+
+    def _drift(self):
+        if self.ref is None:
+            return np.inf
+        delta = sum(((p - q) ** 2).sum() for p, q in zip(self._params(), self.ref))
+        return float((delta / sum((q ** 2).sum() for q in self.ref)).sqrt())
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.lookups, 1)
+
+    def step(self):
+        self.model_version += 1
+        self.since_full += 1
+
+    def score(self, idx):
+        idx = np.asarray(idx, dtype=np.int64)
+        self.drift = self._drift()
+        self.full = self.since_full >= self.every or self.drift > self.max_drift or (self.version[idx] < 0).any()
+        if self.full:
+            rows = idx
+            self.ref, self.since_full = self._params(), 0
+        else:
+            rows = idx[np.argpartition(self.weights[idx], min(self.refresh, len(idx) - 1))[:self.refresh]]
+        self.weights[rows] = self.scorer.score(rows)
+        self.version[rows] = self.model_version
+        self.hits += len(idx) - len(rows)
+        self.lookups += len(idx)
+        return self.weights[idx]
+
+    def state_dict(self):
+        return {'weights': self.weights.copy(), 'version': self.version.copy(),
+                'model_version': self.model_version, 'since_full': self.since_full,
+                'ref': None if self.ref is None else [q.cpu() for q in self.ref],
+                'hits': self.hits, 'lookups': self.lookups}
+
+    def load_state_dict(self, state):
+        self.weights, self.version = state['weights'].copy(), state['version'].copy()
+        self.model_version, self.since_full = state['model_version'], state['since_full']
+        self.ref = None if state['ref'] is None else [q.to(p.device) for q, p in zip(state['ref'], self._params())]
+        self.hits, self.lookups = state['hits'], state['lookups']
+
+
+def _score_worker(X, net1, net2, forward, chunk_size, threads, tasks, results):
+    torch.set_num_threads(threads)
+    scorer = PoolScorer(X, partial(forward, net1, net2), chunk_size)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        shard, idx = task
+        try:
+            with torch.no_grad():
+                results.put((shard, scorer._forward(torch.as_tensor(idx))))
+        except Exception as e:
+            results.put((shard, e))
+
+
+class ShardedScorer(PoolScorer):
+    """PoolScorer that splits every pass over the candidates across worker
+       processes on the CPU. The features and a CPU copy of net1/net2 live in
+       shared memory; the weights are copied into it before each pass and the
+       shards are merged in shard order, so results do not depend on timing.
+       forward(net1, net2, X) -> (f1, f2, dc) must be a module-level function.
+    """
+    def __init__(self, X, net1, net2, forward, workers=4, chunk_size=4096, threads=1):
+        super().__init__(X, None, chunk_size, 'cpu')
+        self.X.share_memory_()
+        self.nets = (net1, net2)
+        self.device = next(net1.parameters()).device
+        self.shared = [copy.deepcopy(net).cpu().share_memory() for net in self.nets]
+        # fork, so the workers do not re-import the calling script
+        ctx = mp.get_context('fork')
+        self.tasks, self.results = ctx.Queue(), ctx.Queue()
+        self.procs = [ctx.Process(target=_score_worker, args=(self.X, *self.shared, forward, chunk_size, threads, self.tasks, self.results), daemon=True)
+                      for _ in range(workers)]
+        for p in self.procs:
+            p.start()
+
+    def _sync(self):
+        with torch.no_grad():
+            for net, shared in zip(self.nets, self.shared):
+                for p, q in zip(net.state_dict().values(), shared.state_dict().values()):
+                    q.copy_(p)
+
+    def _forward(self, idx):
+        self._sync()
+        shards = [s for s in np.array_split(idx.cpu().numpy(), len(self.procs)) if len(s)]
+        for shard, rows in enumerate(shards):
+            self.tasks.put((shard, rows))
+        out = [None] * len(shards)
+        for _ in shards:
+            shard, res = self.results.get()
+            if isinstance(res, Exception):
+                raise res
+            out[shard] = res
+        return tuple(torch.cat(parts).to(self.device) for parts in zip(*out))
+
+    def close(self):
+        for _ in self.procs:
+            self.tasks.put(None)
+        for p in self.procs:
+            p.join()
+
+
+
+class DistributedScorer(PoolScorer):
+    """PoolScorer over torch.distributed (gloo). Every rank copies its contiguous
+       block of the pool to the device; rank 0 runs the active learning loop.
+       For every pass rank 0 broadcasts the weights of net1/net2 and the
+       indices, and each rank scores the ones it owns. score() gathers only the
+       margins to rank 0, lookup() gathers f1 and dc of the few requested rows.
+       Ranks other than 0 call serve() until rank 0 calls close().
+    """
+    MARGINS, ROWS = 1, 2
+
+    def __init__(self, X, net1, net2, forward, chunk_size=4096, device=None):
+        self.rank, self.world = dist.get_rank(), dist.get_world_size()
+        self.n = len(X)
+        self.bounds = np.linspace(0, self.n, self.world + 1).astype(np.int64)
+        lo, hi = self.bounds[self.rank], self.bounds[self.rank + 1]
+        self.nets = (net1, net2)
+        self.device = next(net1.parameters()).device
+        # a copy, so the caller can drop the full pool
+        super().__init__(X[lo:hi].clone(), partial(forward, net1, net2), chunk_size, device)
+        self.offset = lo
+        f1, _, dc = self.forward(self.X[:1])
+        self.k, self.width = f1.shape[1], f1.shape[1] + dc.shape[1] + 1
+
+    def __len__(self):
+        return self.n
+
+    def _broadcast(self, cmd=0, idx=None):
+        # rank 0 sends the command and the indices (cmd 0 stops serve()), the others receive them
+        ctrl = torch.tensor([cmd, 0 if idx is None else len(idx)])
+        dist.broadcast(ctrl, 0)
+        cmd = int(ctrl[0])
+        if cmd == 0:
+            return cmd, None
+        state = [t for net in self.nets for t in net.state_dict().values()]
+        flat = torch.cat([t.detach().flatten().float().cpu() for t in state])
+        dist.broadcast(flat, 0)
+        if self.rank > 0:
+            with torch.no_grad():
+                s = 0
+                for t in state:
+                    t.copy_(flat[s:s + t.numel()].view_as(t))
+                    s += t.numel()
+            idx = torch.empty(int(ctrl[1]), dtype=torch.int64)
+        dist.broadcast(idx, 0)
+        return cmd, idx.numpy()
+
+    def _gather(self, cmd, idx):
+        # MARGINS sends one float per row, ROWS sends f1, dc and the margin
+        width = 1 if cmd == self.MARGINS else self.width
+        owner = np.searchsorted(self.bounds, idx, 'right') - 1
+        mine = idx[owner == self.rank]
+        part = torch.zeros(np.bincount(owner, minlength=self.world).max(), width)
+        if len(mine):
+            with torch.no_grad():
+                f1, dc, w = PoolScorer._forward(self, torch.as_tensor(mine, device=self.X.device))
+            res = w.unsqueeze(1) if cmd == self.MARGINS else torch.cat([f1, dc, w.unsqueeze(1)], 1)
+            part[:len(mine)] = res.float().cpu()
+        parts = [torch.empty_like(part) for _ in range(self.world)] if self.rank == 0 else None
+        dist.gather(part, parts, 0)
+        if self.rank > 0:
+            return None
+        out = torch.empty(len(idx), width)
+        for r, p in enumerate(parts):
+            pos = np.flatnonzero(owner == r)
+            out[pos] = p[:len(pos)]
+        return out.to(self.device)
+
+    def _forward(self, idx):
+        out = self._gather(*self._broadcast(self.ROWS, idx.cpu()))
+        return out[:, :self.k], out[:, self.k:-1], out[:, -1]
+
+    def score(self, idx):
+        # nothing is cached, lookup() fetches f1 and dc of the selected rows
+        idx = np.asarray(idx, dtype=np.int64)
+        self.clear()
+        if len(idx) == 0:
+            return np.zeros(0)
+        return self._gather(*self._broadcast(self.MARGINS, torch.as_tensor(idx)))[:, 0].double().cpu().numpy()
+
+    def serve(self):
+        while True:
+            cmd, idx = self._broadcast()
+            if cmd == 0:
+                return
+            self._gather(cmd, idx)
+
+    def close(self):
+        if self.rank == 0:
+            self._broadcast()
+
+
+def sample_distribution(weights, mu, gamma, size, rng=np.random):
+    """Draws size positions of weights without replacement, with probability
+       w_hat / (mu * w_hat + gamma * (w - w_hat)) for every candidate except the
+       argmin, which takes the remaining mass. Candidates tied with the minimum
+       get 1 / mu, which is also the limit when w_hat is 0.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    i_hat = np.argmin(weights)
+    w_hat = weights[i_hat]
+    gap = weights - w_hat
+    quotient = mu * w_hat + gamma * gap
+    p = np.where(gap > 0, w_hat / np.where(gap > 0, quotient, 1), 1 / mu)
+    p[i_hat] = 0
+    p[i_hat] = max(1 - p.sum(), 0)
+    p /= p.sum()
+
+    # exponential keys: the size smallest -log(U) / p are a draw without replacement
+    size = min(size, len(p))
+    nonzero = np.flatnonzero(p > 0)
+    if len(nonzero) <= size:
+        zero = np.flatnonzero(p == 0)
+        return np.concatenate([nonzero, rng.choice(zero, size - len(nonzero), replace=False)])
+    keys = rng.exponential(size=len(nonzero)) / p[nonzero]
+    return nonzero[np.argpartition(keys, size - 1)[:size]]
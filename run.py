@@ -5,8 +5,15 @@ from neuronal_pool import run as run_pool
 #from neual_ntk import run as run_ntk
 from neual_ntk import run as run_ntk
 from alps import run as run_alps
+import os
 import argparse
 
+def explore_size(default):
+    # the block reducer needs the table size, --reducer sketch can use any width
+    if args.es:
+        return int(args.es)
+    return default
+
 def run(i, args):
     f_name = ''
     if method == "a":
@@ -17,34 +24,38 @@ def run(i, args):
     
     if method == "d":
         print(f"NeuAL-NTK on {datasets[i]}")
-        inf_time, train_time, test_inf_time = run_ntk(n=num_rounds, budget=budget, num_epochs=num_epochs, dataset_name=datasets[i], begin=begin[i], explore_size=in_es[i])
+        inf_time, train_time, test_inf_time = run_ntk(n=num_rounds, budget=budget, num_epochs=num_epochs, dataset_name=datasets[i], begin=begin[i], explore_size=in_es[i], embedding=args.emb)
         
         f_name = 'runtimes_ntk.txt'
 
     if method == 'm':
         print(f"Margin on {datasets[i]}")
-        inf_time, train_time, test_inf_time = run_margin(n=num_rounds, margin=6, budget=budget, num_epochs=num_epochs, dataset_name=datasets[i], begin=begin[i], explore_size=in_es[i])
+        inf_time, train_time, test_inf_time = run_margin(n=num_rounds, margin=6, budget=budget, num_epochs=num_epochs, dataset_name=datasets[i], begin=begin[i], explore_size=in_es[i], embedding=args.emb)
         
         f_name = 'runtimes_margin.txt'
 
     if method == 'i':
         print(f"I-NeurAL on {datasets[i]}")
-        inf_time, train_time, test_inf_time = run_ineural(n=num_rounds, margin=6, num_labels=budget, num_epochs=num_epochs, dataset_name=datasets[i], explore_size=in_es[i], begin=begin[i])
+        inf_time, train_time, test_inf_time = run_ineural(n=num_rounds, margin=6, num_labels=budget, num_epochs=num_epochs, dataset_name=datasets[i], explore_size=explore_size(in_es[i]), begin=begin[i], embedding=args.emb, reducer=args.reducer)
         
         f_name = 'runtimes_ineural.txt'
 
     if method == 's':
         print(f"NeurONAL-Stream on {datasets[i]}")
-        inf_time, train_time, test_inf_time = run_stream(n=num_rounds, margin=6, budget=budget, num_epochs=num_epochs, dataset_name=datasets[i], explore_size=npg_es[i], begin=begin[i])
+        inf_time, train_time, test_inf_time = run_stream(n=num_rounds, margin=6, budget=budget, num_epochs=num_epochs, dataset_name=datasets[i], explore_size=explore_size(npg_es[i]), begin=begin[i], embedding=args.emb, reducer=args.reducer, train_mode=args.train, update_steps=int(args.steps), train_async=args.async_train, window=int(args.window), window_mode=args.window_mode, checkpoint_every=int(args.ckpt), resume=args.resume)
         
         f_name = 'runtimes_neuronal.txt'
     
     if method == 'p':
         print(f'NeurONAL-Pool on {datasets[i]}')
-        inf_time, train_time, test_inf_time = run_pool(dev=args.dev, n=num_rounds, margin=6, budget=budget, num_epochs=num_epochs, dataset_name=datasets[i], explore_size=npg_es[i], begin=begin[i], j=int(args.j))
+        inf_time, train_time, test_inf_time = run_pool(dev=args.dev, n=num_rounds, margin=6, budget=budget, num_epochs=num_epochs, dataset_name=datasets[i], explore_size=explore_size(npg_es[i]), begin=begin[i], j=int(args.j), embedding=args.emb, reducer=args.reducer, minibatch=int(args.minibatch), workers=int(args.workers), distributed=args.dist, cascade=int(args.cascade), cascade_random=int(args.cascade_random), cascade_audit=int(args.cascade_audit), rescore_every=int(args.rescore_every), max_drift=None if args.max_drift is None else float(args.max_drift), refresh=int(args.refresh))
 
         f_name = 'runtimes_batch_neuronal.txt'
 
+    # only rank 0 of a torchrun launch reports times
+    if args.dist and int(os.environ.get('RANK', 0)) > 0:
+        return
+
     with open(f_name, 'a') as f:
         f.write(f'{num_rounds}, {datasets[i]}, {inf_time}, {train_time}, {test_inf_time}\n')
 
@@ -59,8 +70,27 @@ argparser.add_argument('--b', help='budget percentage', default='0.3')
 argparser.add_argument('--ne', help='number of epochs', default='128')
 argparser.add_argument('--method', help='\'a\' for ALPS, \'d\' for NeuAL-NTK, \'m\' for Margin, \'i\' for I-NeurAL and \'s\' for NeurONAL-Stream, \'p\' for NeurONAL-Pool', default='a')
 argparser.add_argument('--dataset', help='-1 for all, 0-5 for Letter, Covertype, MT, Shuttle, Adult, or Fashion', default=0)
-argparser.add_argument('--j', help='Last checkpoint number saved', default=0)
+argparser.add_argument('--j', help='NeurONAL-Pool: resume from the checkpoint saved after this many queries', default=0)
 argparser.add_argument('--dev', help='GPU device number', default='3')
+argparser.add_argument('--reducer', help='exploration embedding: \'block\' (block mean) or \'sketch\' (seeded sparse random projection)', default='block')
+argparser.add_argument('--es', help='exploration network input width (default: the block reducer size table)', default=None)
+argparser.add_argument('--train', help='NeurONAL-Stream updates: \'full\' (retrain on all labels) or \'incremental\' (--steps optimizer steps per label)', default='full')
+argparser.add_argument('--steps', help='optimizer steps per new label for --train incremental', default='8')
+argparser.add_argument('--async_train', help='NeurONAL-Stream: train on a background thread and keep scoring with the last published weights', action='store_true')
+argparser.add_argument('--window', help='NeurONAL-Stream: arrivals scored together in one batched pass', default='1')
+argparser.add_argument('--window_mode', help='\'freeze\' keeps the window scores after a query, \'rescore\' re-scores the rest of the window', default='freeze')
+argparser.add_argument('--ckpt', help='NeurONAL-Stream: save a checkpoint every this many queries (0 disables)', default='0')
+argparser.add_argument('--resume', help='NeurONAL-Stream: resume from the last checkpoint', action='store_true')
+argparser.add_argument('--minibatch', help='NeurONAL-Pool: samples per optimizer step in training (1 is one step per sample)', default='64')
+argparser.add_argument('--workers', help='NeurONAL-Pool: CPU processes that score the pool (0 scores in-process)', default='0')
+argparser.add_argument('--dist', help='NeurONAL-Pool: score the pool across torch.distributed ranks (launch with torchrun)', action='store_true')
+argparser.add_argument('--cascade', help='NeurONAL-Pool: fully score only this many candidates with the smallest net1 margin (0 scores all)', default='0')
+argparser.add_argument('--cascade_random', help='NeurONAL-Pool: extra candidates drawn uniformly for full scoring with --cascade, used to correct the net1 margins of the rest', default='100')
+argparser.add_argument('--cascade_audit', help='NeurONAL-Pool: every this many rounds, count how many selected points the cascade changed against full scoring (0 never)', default='2')
+argparser.add_argument('--rescore_every', help='NeurONAL-Pool: rescore the whole pool every this many rounds, reusing cached margins in between (1 rescores every round)', default='1')
+argparser.add_argument('--max_drift', help='NeurONAL-Pool: also rescore the whole pool once the relative weight change since the last full rescore exceeds this', default=None)
+argparser.add_argument('--refresh', help='NeurONAL-Pool: cached candidates with the smallest margin rescored in the other rounds', default='1000')
+argparser.add_argument('--emb', help='gradient embedding: \'autograd\', \'closed_form\' (two-layer fast path) or \'factored\' (never builds the full gradient)', default='autograd')
 args = argparser.parse_args()
 budget = float(args.b)
 num_epochs = int(args.ne)
@@ -0,0 +1,62 @@
+import os
+import json
+import time
+import atexit
+from datetime import datetime
+
+
+class RunLogger:
+    """Buffers per-iteration records in memory and appends them to a CSV file
+       in blocks, every max_records records or max_seconds seconds. The CSV has
+       no header so the plotting notebooks keep working; the columns and run
+       metadata go to one JSON line per run in <path>.meta.
+    """
+    def __init__(self, path, columns, meta=None, max_records=1000, max_seconds=30.0, print_every=100):
+        self.path, self.columns = path, columns
+        self.max_records, self.max_seconds, self.print_every = max_records, max_seconds, print_every
+        self._lines, self._count = [], 0
+        self._last_flush = time.time()
+
+        header = {'columns': columns, 'start_byte': os.path.getsize(path) if os.path.exists(path) else 0,
+                  'started': datetime.now().isoformat(timespec='seconds')}
+        header.update(meta or {})
+        with open(path + '.meta', 'a') as f:
+            f.write(json.dumps(header) + '\n')
+        # an interrupted run still writes what it has buffered
+        atexit.register(self.flush)
+
+    def record(self, *values):
+        line = ','.join(str(v) for v in values)
+        self._lines.append(line)
+        self._count += 1
+        if self.print_every and self._count % self.print_every == 0:
+            print(line)
+        if len(self._lines) >= self.max_records or time.time() - self._last_flush >= self.max_seconds:
+            self.flush()
+
+    def note(self, text):
+        # free-form line (e.g. testing accuracy), kept in order with the records
+        print(text)
+        self._lines.append(text)
+        self.flush()
+
+    def flush(self):
+        if self._lines:
+            with open(self.path, 'a') as f:
+                f.write('\n'.join(self._lines) + '\n')
+            self._lines = []
+        self._last_flush = time.time()
+
+    def checkpoint(self):
+        # flushes and returns the file size, so a resumed run can cut off later records
+        self.flush()
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def restore(self, size):
+        self._lines = []
+        with open(self.path, 'a') as f:
+            f.truncate(size)
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)